@@ -1,21 +1,46 @@
 from flask import Flask, render_template, request, jsonify
-import os
-from werkzeug.utils import secure_filename
+import io
+import logging
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from fingerprint import AudioFingerprinter
 from matcher import AudioMatcher
-import time
 
 app = Flask(__name__, template_folder='../frontend/templates', static_folder='../frontend/static')
 
 # Configuration
-UPLOAD_FOLDER = 'data/uploads'
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'm4a'}
 
-# Create upload folder if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Fingerprinting is CPU-bound, so it runs in worker processes where it does
+# not hold the GIL against other request threads. Spawned rather than forked
+# because the server process is multithreaded.
+FINGERPRINT_POOL = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+def _fingerprint_upload(audio_bytes):
+    """Fingerprint an uploaded clip's bytes (runs in a worker process)."""
+    return AudioFingerprinter().fingerprint_arrays(io.BytesIO(audio_bytes))
+
+# Idle matchers (each with its own SQLite connection), reused across requests
+_matcher_pool = queue.SimpleQueue()
+
+@contextmanager
+def get_matcher():
+    """Borrow an AudioMatcher from the pool, creating one if none is idle."""
+    try:
+        matcher = _matcher_pool.get_nowait()
+    except queue.Empty:
+        # Request threads come and go, so connections must not be thread-bound
+        matcher = AudioMatcher(check_same_thread=False)
+    
+    try:
+        yield matcher
+    finally:
+        _matcher_pool.put(matcher)
+
 def allowed_file(filename):
     """Check if file extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -44,23 +69,14 @@ def identify():
         return jsonify({'error': 'Invalid file type. Please upload MP3, WAV, or M4A'}), 400
     
     try:
-        # Save the uploaded file
-        filename = secure_filename(file.filename)
-        timestamp = str(int(time.time()))
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        # Initialize matcher
-        matcher = AudioMatcher()
+        # Decode straight from memory; the upload never touches the disk
+        audio_bytes = file.read()
         
-        # Match the audio clip
-        result = matcher.match_clip(filepath, min_confidence=5)
+        # Fingerprint in a worker process, then match with a pooled matcher
+        hashes, offsets = FINGERPRINT_POOL.submit(_fingerprint_upload, audio_bytes).result()
         
-        matcher.close()
-        
-        # Clean up uploaded file
-        os.remove(filepath)
+        with get_matcher() as matcher:
+            result = matcher.match_fingerprints(hashes, offsets, min_confidence=5)
         
         # Return results
         if result:
@@ -90,6 +106,8 @@ def health():
     return jsonify({'status': 'ok'})
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     print("\n" + "="*70)
     print("🎵 MEDIA RECOGNITION WEB SERVER")
     print("="*70)
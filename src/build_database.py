@@ -1,8 +1,17 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from numba import set_num_threads
 from fingerprint import AudioFingerprinter
+from fingerprint_cache import FingerprintCache, source_key
 from database import FingerprintDatabase
+import logging
+import os
 import re
 
+# Season/episode markers in filenames (e.g. s01e01, S05E14)
+_SE_RE = re.compile(r's(\d+)e(\d+)', re.IGNORECASE)
+_SE_SUB = re.compile(r's\d+e\d+', re.IGNORECASE)
+
 def parse_filename(file_path):
     """
     Extract metadata from filename and path.
@@ -20,13 +29,13 @@ def parse_filename(file_path):
     # Check if it's a TV show (in tv_shows folder)
     if grandparent_folder == "tv_shows":
         # Extract season/episode if in filename (e.g., s01e01, S05E14)
-        match = re.search(r's(\d+)e(\d+)', file_name, re.IGNORECASE)
+        match = _SE_RE.search(file_name)
         
         if match:
             season = int(match.group(1))
             episode = int(match.group(2))
             # Remove season/episode from title
-            title = re.sub(r's\d+e\d+', '', file_name, flags=re.IGNORECASE).strip('_ -')
+            title = _SE_SUB.sub('', file_name).strip('_ -')
         else:
             season = None
             episode = None
@@ -53,19 +62,82 @@ def parse_filename(file_path):
             'show_name': None
         }
 
-def build_database(data_dir="data"):
+def _prefetch(file_path):
+    """
+    Ask the kernel to start reading a file into the page cache.
+    
+    The read-ahead runs asynchronously, so a worker that opens the file
+    later finds it already in memory. No-op where posix_fadvise is missing.
+    
+    Args:
+        file_path: Path to audio file
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def _fingerprint_one(file_path, cache_dir=None):
+    """
+    Fingerprint a single audio file (runs in a worker process).
+    
+    Args:
+        file_path: Path to audio file
+        cache_dir: Fingerprint cache directory, or None to always recompute
+        
+    Returns:
+        hashes: int64 array of hashes
+        offsets: int64 array of time offsets
+    """
+    # The process pool already uses every core; avoid oversubscribing with JIT threads
+    set_num_threads(1)
+    
+    fingerprinter = AudioFingerprinter()
+    cache = FingerprintCache(cache_dir) if cache_dir else None
+    
+    # Reuse fingerprints of files that haven't changed since the last build
+    if cache:
+        cached = cache.get(file_path, fingerprinter)
+        if cached is not None:
+            print(f"♻️  Using cached fingerprints for {Path(file_path).name}")
+            return cached
+    
+    # Arrays pickle back to the parent as two buffers, not one object per tuple
+    hashes, offsets = fingerprinter.fingerprint_arrays(str(file_path))
+    
+    if cache:
+        cache.put(file_path, fingerprinter, hashes, offsets)
+    
+    return hashes, offsets
+
+def build_database(data_dir="data", workers=None, cache_dir="database/fp_cache"):
     """
     Build the fingerprint database from all audio files.
     
+    Files are fingerprinted in parallel worker processes; all database
+    writes happen in this process through a single connection. Files that
+    are already in the database are skipped, so reruns only add new media;
+    files changed since they were added are fingerprinted again and their
+    old fingerprints replaced.
+    
     Args:
         data_dir: Root directory containing audio files
+        workers: Number of fingerprinting processes (defaults to CPU count)
+        cache_dir: Fingerprint cache directory, or None to disable caching
     """
     print("="*70)
     print("🎵 BUILDING FINGERPRINT DATABASE")
     print("="*70)
     
     # Initialize components
-    fingerprinter = AudioFingerprinter()
     db = FingerprintDatabase()
     
     # Find all audio files
@@ -73,45 +145,120 @@ def build_database(data_dir="data"):
     audio_files = list(data_path.rglob("*.mp3"))
     
     print(f"\n📁 Found {len(audio_files)} audio files")
+    
+    # Re-inserting existing media would duplicate all of their fingerprints,
+    # so only files that are new or changed since they were added are queued
+    existing = {media['file_path']: media for media in db.get_all_media()
+                if media['fingerprint_count']}
+    fingerprinter = AudioFingerprinter()
+    
+    source_keys = {}
+    changed = set()
+    queued = []
+    for audio_file in audio_files:
+        try:
+            key = source_key(audio_file, fingerprinter)
+        except OSError as e:
+            print(f"❌ Error reading {audio_file.name}: {e}")
+            continue
+        
+        media = existing.get(str(audio_file))
+        if media is not None:
+            if media['source_key'] == key:
+                continue
+            changed.add(audio_file)
+        
+        source_keys[audio_file] = key
+        queued.append(audio_file)
+    
+    skipped = len(audio_files) - len(queued)
+    audio_files = queued
+    if skipped:
+        print(f"⏭️  Skipping {skipped} files already in the database")
+    if changed:
+        print(f"🔄 Re-fingerprinting {len(changed)} changed files")
     print("="*70)
     
-    # Process each file
-    for idx, audio_file in enumerate(audio_files, 1):
-        print(f"\n[{idx}/{len(audio_files)}] Processing: {audio_file.name}")
-        print("-"*70)
+    # Bulk load without the hash index; it is rebuilt once at the end
+    db.drop_hash_index()
+    
+    workers = workers or os.cpu_count() or 1
+    
+    # At most this many files are queued or running at once; their reads
+    # are prefetched as they are submitted
+    max_in_flight = 2 * workers
+    
+    # Fingerprint files in parallel, inserting results as they finish
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(audio_files)
+        pending = {}
         
-        try:
-            # Parse metadata from filename
-            metadata = parse_filename(audio_file)
-            
-            # Display metadata
-            if metadata['type'] == 'tv':
-                display_title = f"{metadata['show_name']}"
-                if metadata['season'] and metadata['episode']:
-                    display_title += f" - S{metadata['season']:02d}E{metadata['episode']:02d}"
-                print(f"📺 TV Show: {display_title}")
-            else:
-                print(f"🎬 Movie: {metadata['title']}")
-            
-            # Generate fingerprints
-            fingerprints = fingerprinter.fingerprint_file(str(audio_file))
-            
-            # Add to database
-            media_id = db.add_media(
-                title=metadata['title'],
-                media_type=metadata['type'],
-                file_path=str(audio_file),
-                season=metadata['season'],
-                episode=metadata['episode']
-            )
-            
-            db.add_fingerprints(media_id, fingerprints)
-            
-            print(f"✅ Successfully processed!")
+        def submit_next():
+            audio_file = next(remaining, None)
+            if audio_file is not None:
+                _prefetch(audio_file)
+                pending[executor.submit(_fingerprint_one, audio_file, cache_dir)] = audio_file
+        
+        for _ in range(max_in_flight):
+            submit_next()
+        
+        idx = 0
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
             
-        except Exception as e:
-            print(f"❌ Error processing {audio_file.name}: {e}")
-            continue
+            for future in done:
+                # Forget the future so its result is freed once inserted
+                audio_file = pending.pop(future)
+                submit_next()
+                idx += 1
+                
+                print(f"\n[{idx}/{len(audio_files)}] Processing: {audio_file.name}")
+                print("-"*70)
+                
+                try:
+                    # Parse metadata from filename
+                    metadata = parse_filename(audio_file)
+                    
+                    # Display metadata
+                    if metadata['type'] == 'tv':
+                        display_title = f"{metadata['show_name']}"
+                        if metadata['season'] and metadata['episode']:
+                            display_title += f" - S{metadata['season']:02d}E{metadata['episode']:02d}"
+                        print(f"📺 TV Show: {display_title}")
+                    else:
+                        print(f"🎬 Movie: {metadata['title']}")
+                    
+                    # Collect fingerprints from the worker
+                    hashes, offsets = future.result()
+                    
+                    # Add to database in a single transaction per file, so a
+                    # changed file never loses its old fingerprints on failure
+                    db.begin()
+                    media_id = db.add_media(
+                        title=metadata['title'],
+                        media_type=metadata['type'],
+                        file_path=str(audio_file),
+                        season=metadata['season'],
+                        episode=metadata['episode'],
+                        source_key=source_keys[audio_file]
+                    )
+                    
+                    if audio_file in changed:
+                        db.delete_fingerprints(media_id)
+                    
+                    db.add_fingerprints(media_id, zip(hashes.tolist(), offsets.tolist()))
+                    db.commit()
+                    
+                    print(f"✅ Successfully processed!")
+                    
+                except Exception as e:
+                    db.rollback()
+                    print(f"❌ Error processing {audio_file.name}: {e}")
+                    continue
+    
+    print("\nBuilding hash index...")
+    db.create_hash_index()
+    db.export_columnar()
     
     # Display final statistics
     print("\n" + "="*70)
@@ -146,4 +293,5 @@ def build_database(data_dir="data"):
     print("="*70)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     build_database()
\ No newline at end of file
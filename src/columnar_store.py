@@ -0,0 +1,171 @@
+import json
+import os
+import numpy as np
+from pathlib import Path
+
+# Bloom filter size in bits per stored fingerprint (one probe per hash)
+BLOOM_BITS_PER_ENTRY = 8
+
+def _bloom_slots(hashes, n_words):
+    """
+    Map hashes to their Bloom filter word and bit.
+    
+    Packed fingerprint hashes are far from uniform, so they are spread
+    with a multiplicative (Fibonacci) hash first.
+    
+    Args:
+        hashes: int64 array of hashes
+        n_words: Number of uint64 words in the filter, a power of two
+        
+    Returns:
+        words: Index of each hash's word
+        bits: Bit position of each hash within its word
+    """
+    mixed = hashes.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    words = ((mixed >> np.uint64(32)) & np.uint64(n_words - 1)).astype(np.intp)
+    bits = mixed >> np.uint64(58)
+    return words, bits
+
+class ColumnarStore:
+    """
+    Read-only columnar snapshot of the fingerprints table.
+    
+    Fingerprints are kept as three parallel arrays sorted by hash, so a
+    lookup is a binary search over a memory-mapped int64 array instead of
+    a B-tree traversal in SQLite. A Bloom filter over the stored hashes
+    rejects most absent query hashes before they reach the binary search.
+    """
+    
+    def __init__(self, store_dir):
+        """
+        Initialize the store.
+        
+        Args:
+            store_dir: Directory holding the .npy arrays
+        """
+        self.store_dir = Path(store_dir)
+        
+        self.hashes = None
+        self.offsets = None
+        self.media_ids = None
+        self.bloom = None
+    
+    def write(self, hashes, offsets, media_ids, version):
+        """
+        Write a new snapshot to disk.
+        
+        Args:
+            hashes: int64 array of hashes, sorted ascending
+            offsets: int32 array of time offsets
+            media_ids: int32 array of media IDs
+            version: Marker of the table state the snapshot was taken from
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        
+        self._replace("hashes.npy", hashes.astype(np.int64, copy=False))
+        self._replace("offsets.npy", offsets.astype(np.int32, copy=False))
+        self._replace("media_ids.npy", media_ids.astype(np.int32, copy=False))
+        self._replace("bloom.npy", self._build_bloom(hashes))
+        
+        # Written last so a partial snapshot never looks current
+        tmp_path = self.store_dir / "meta.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'version': version, 'count': len(hashes)}, f)
+        os.replace(tmp_path, self.store_dir / "meta.json")
+        
+        print(f"✅ Wrote columnar snapshot ({len(hashes):,} fingerprints)")
+    
+    def _build_bloom(self, hashes):
+        """
+        Build a single-probe Bloom filter over the stored hashes.
+        
+        Args:
+            hashes: int64 array of hashes
+            
+        Returns:
+            uint64 array of filter words
+        """
+        n_bits = max(len(hashes) * BLOOM_BITS_PER_ENTRY, 64)
+        n_words = 1 << ((n_bits - 1).bit_length() - 6)
+        
+        bloom = np.zeros(n_words, dtype=np.uint64)
+        words, bits = _bloom_slots(np.asarray(hashes, dtype=np.int64), n_words)
+        np.bitwise_or.at(bloom, words, np.uint64(1) << bits)
+        return bloom
+    
+    def _replace(self, name, array):
+        """
+        Atomically replace one array file.
+        
+        Readers that already memory-mapped the old file keep a valid view.
+        
+        Args:
+            name: File name inside the store directory
+            array: Array to save
+        """
+        tmp_path = self.store_dir / f"{name}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, self.store_dir / name)
+    
+    def load(self, version):
+        """
+        Memory-map the snapshot if it matches the given table state.
+        
+        Args:
+            version: Marker of the current table state
+            
+        Returns:
+            True if a current snapshot was loaded
+        """
+        meta_path = self.store_dir / "meta.json"
+        if not meta_path.exists():
+            return False
+        
+        with open(meta_path) as f:
+            meta = json.load(f)
+        
+        if version is None or meta['version'] != version:
+            return False
+        
+        self.hashes = np.load(self.store_dir / "hashes.npy", mmap_mode='r')
+        self.offsets = np.load(self.store_dir / "offsets.npy", mmap_mode='r')
+        self.media_ids = np.load(self.store_dir / "media_ids.npy", mmap_mode='r')
+        
+        # Snapshots written before the filter existed just skip it
+        bloom_path = self.store_dir / "bloom.npy"
+        self.bloom = np.load(bloom_path, mmap_mode='r') if bloom_path.exists() else None
+        return True
+    
+    def search(self, query_hashes):
+        """
+        Search for matching fingerprints.
+        
+        Args:
+            query_hashes: Integer hashes to search for
+            
+        Returns:
+            media_ids: int64 array of media IDs of the matching rows
+            hashes: int64 array of matching hashes
+            time_offsets: int64 array of time offsets
+        """
+        query = np.unique(np.asarray(query_hashes, dtype=np.int64))
+        
+        # Drop hashes the filter proves absent (no false negatives)
+        if self.bloom is not None and len(query):
+            words, bits = _bloom_slots(query, len(self.bloom))
+            query = query[((self.bloom[words] >> bits) & np.uint64(1)).astype(bool)]
+        
+        # Each query hash matches a contiguous run of the sorted hash array
+        starts = np.searchsorted(self.hashes, query, side='left')
+        ends = np.searchsorted(self.hashes, query, side='right')
+        run_lengths = ends - starts
+        
+        # Expand the runs into one gather index per matching row
+        run_offsets = np.cumsum(run_lengths) - run_lengths
+        idx = (np.repeat(starts, run_lengths)
+               + np.arange(run_lengths.sum()) - np.repeat(run_offsets, run_lengths))
+        
+        return (self.media_ids[idx].astype(np.int64),
+                self.hashes[idx],
+                self.offsets[idx].astype(np.int64))
@@ -1,17 +1,24 @@
 import sqlite3
+import uuid
+import numpy as np
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
+from columnar_store import ColumnarStore
 
 class FingerprintDatabase:
     """
     Manage storage and retrieval of audio fingerprints.
     """
     
-    def __init__(self, db_path="database/fingerprints.db"):
+    def __init__(self, db_path="database/fingerprints.db", check_same_thread=True):
         """
         Initialize database connection.
         
         Args:
             db_path: Path to SQLite database file
+            check_same_thread: Restrict the connection to the creating thread;
+                pass False when one thread at a time hands it around
         """
         self.db_path = db_path
         
@@ -19,9 +26,37 @@ class FingerprintDatabase:
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         
         # Initialize database
-        self.conn = sqlite3.connect(db_path)
+        self.conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
         self.cursor = self.conn.cursor()
+        
+        # True while an explicit begin()/commit() batch is open
+        self._in_batch = False
+        
+        self._configure_connection()
         self._create_tables()
+        
+        # Columnar snapshot of the fingerprints table, used for search when current
+        self.columnar = ColumnarStore(Path(db_path).with_suffix('.columnar'))
+        self.columnar_token = None
+        self._refresh_columnar()
+        
+        # Media rows are tiny and looked up on every match; batch runs hit
+        # the same few media over and over
+        self._media_info_cache = lru_cache(maxsize=4096)(self._fetch_media_info)
+    
+    def _configure_connection(self):
+        """
+        Tune SQLite for bulk inserts and concurrent readers.
+        """
+        # page_size only takes effect on a new database, so it goes first
+        self.cursor.executescript("""
+            PRAGMA page_size=8192;
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA cache_size=-262144;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+        """)
     
     def _create_tables(self):
         """
@@ -37,31 +72,74 @@ class FingerprintDatabase:
                 episode INTEGER,
                 file_path TEXT NOT NULL UNIQUE,
                 fingerprint_count INTEGER DEFAULT 0,
+                source_key TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
+        # Databases built before source keys were recorded
+        self.cursor.execute("PRAGMA table_info(media)")
+        if 'source_key' not in {row[1] for row in self.cursor.fetchall()}:
+            self.cursor.execute("ALTER TABLE media ADD COLUMN source_key TEXT")
+        
         # Fingerprints table
+        self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fingerprints'"
+        )
+        new_fingerprints = self.cursor.fetchone() is None
+        
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS fingerprints (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                hash TEXT NOT NULL,
+                hash INTEGER NOT NULL,
                 time_offset INTEGER NOT NULL,
                 media_id INTEGER NOT NULL,
                 FOREIGN KEY (media_id) REFERENCES media(id)
             )
         """)
         
-        # Create index for fast hash lookups
+        # Token of the columnar snapshot matching the fingerprints table
         self.cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_hash 
-            ON fingerprints(hash)
+            CREATE TABLE IF NOT EXISTS columnar_snapshot (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                token TEXT NOT NULL
+            )
         """)
         
+        # Create index for fast hash lookups. Only on a fresh table: another
+        # connection may have dropped it for a bulk load, and build_database
+        # recreates it once the load is done
+        if new_fingerprints:
+            self.create_hash_index()
+        
         self.conn.commit()
         print("✅ Database tables created/verified")
     
-    def add_media(self, title, media_type, file_path, season=None, episode=None):
+    def create_hash_index(self):
+        """
+        Create the covering index used by search_fingerprints.
+        
+        The index holds every column the search reads, so lookups never
+        touch the table itself.
+        """
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_hash 
+            ON fingerprints(hash, media_id, time_offset)
+        """)
+        self._commit_unless_batched()
+    
+    def drop_hash_index(self):
+        """
+        Drop the hash index ahead of a bulk load.
+        
+        Rebuilding the index once with create_hash_index() is much cheaper
+        than updating it for every inserted row.
+        """
+        self.cursor.execute("DROP INDEX IF EXISTS idx_hash")
+        self._commit_unless_batched()
+    
+    def add_media(self, title, media_type, file_path, season=None, episode=None,
+                  source_key=None):
         """
         Add a media item to the database.
         
@@ -71,17 +149,20 @@ class FingerprintDatabase:
             file_path: Path to audio file
             season: Season number (for TV shows)
             episode: Episode number (for TV shows)
+            source_key: Key of the file contents the fingerprints come from;
+                updated on an existing media item
             
         Returns:
             media_id: ID of the inserted media
         """
         try:
             self.cursor.execute("""
-                INSERT INTO media (title, type, season, episode, file_path)
-                VALUES (?, ?, ?, ?, ?)
-            """, (title, media_type, season, episode, file_path))
+                INSERT INTO media (title, type, season, episode, file_path, source_key)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (title, media_type, season, episode, file_path, source_key))
             
-            self.conn.commit()
+            self._media_info_cache.cache_clear()
+            self._commit_unless_batched()
             media_id = self.cursor.lastrowid
             
             print(f"✅ Added media: {title} (ID: {media_id})")
@@ -94,62 +175,306 @@ class FingerprintDatabase:
             """, (file_path,))
             
             media_id = self.cursor.fetchone()[0]
+            
+            if source_key is not None:
+                self.cursor.execute("""
+                    UPDATE media SET source_key = ? WHERE id = ?
+                """, (source_key, media_id))
+                self._commit_unless_batched()
+            
             print(f"ℹ️  Media already exists: {title} (ID: {media_id})")
             return media_id
     
-    def add_fingerprints(self, media_id, fingerprints):
+    def add_fingerprints(self, media_id, fingerprints, chunk_size=50000):
         """
         Add fingerprints for a media item.
         
+        Rows are inserted in fixed-size chunks so memory stays bounded no
+        matter how long the media is.
+        
         Args:
             media_id: ID of the media item
-            fingerprints: List of (hash, time_offset) tuples
+            fingerprints: Iterable of (hash, time_offset) tuples
+            chunk_size: Number of rows per executemany call
         """
-        # Prepare data for batch insert
-        data = [(hash_val, time_offset, media_id) 
-                for hash_val, time_offset in fingerprints]
+        # Stream rows for batch insert
+        data = ((hash_val, time_offset, media_id) 
+                for hash_val, time_offset in fingerprints)
+        
+        inserted = 0
+        while True:
+            chunk = list(islice(data, chunk_size))
+            if not chunk:
+                break
+            
+            # Batch insert
+            self.cursor.executemany("""
+                INSERT INTO fingerprints (hash, time_offset, media_id)
+                VALUES (?, ?, ?)
+            """, chunk)
+            inserted += self.cursor.rowcount
         
-        # Batch insert
-        self.cursor.executemany("""
-            INSERT INTO fingerprints (hash, time_offset, media_id)
-            VALUES (?, ?, ?)
-        """, data)
+        # Any existing columnar snapshot no longer matches the table
+        self.cursor.execute("DELETE FROM columnar_snapshot")
+        self.columnar_token = None
         
         # Update fingerprint count
         self.cursor.execute("""
             UPDATE media 
             SET fingerprint_count = ?
             WHERE id = ?
-        """, (len(fingerprints), media_id))
+        """, (inserted, media_id))
+        
+        self._media_info_cache.cache_clear()
+        self._commit_unless_batched()
         
+        print(f"✅ Added {inserted} fingerprints for media ID {media_id}")
+    
+    def delete_fingerprints(self, media_id):
+        """
+        Delete all fingerprints of a media item (e.g. before re-adding them).
+        
+        Args:
+            media_id: ID of the media item
+        """
+        self.cursor.execute("DELETE FROM fingerprints WHERE media_id = ?", (media_id,))
+        
+        # Any existing columnar snapshot no longer matches the table
+        self.cursor.execute("DELETE FROM columnar_snapshot")
+        self.columnar_token = None
+        
+        self.cursor.execute("""
+            UPDATE media 
+            SET fingerprint_count = 0
+            WHERE id = ?
+        """, (media_id,))
+        
+        self._media_info_cache.cache_clear()
+        self._commit_unless_batched()
+    
+    def begin(self):
+        """
+        Start a transaction spanning several inserts.
+        
+        add_media and add_fingerprints skip their own commits until commit()
+        or rollback() is called.
+        """
+        self.cursor.execute("BEGIN")
+        self._in_batch = True
+    
+    def commit(self):
+        """
+        Commit the current transaction.
+        """
         self.conn.commit()
+        self._in_batch = False
+    
+    def rollback(self):
+        """
+        Roll back the current transaction.
+        """
+        self.conn.rollback()
+        self._media_info_cache.cache_clear()
+        self._in_batch = False
+    
+    def _commit_unless_batched(self):
+        """
+        Commit immediately unless inside a begin()/commit() batch.
+        """
+        if not self._in_batch:
+            self.conn.commit()
+    
+    def export_columnar(self):
+        """
+        Write a columnar snapshot of the fingerprints table for fast search.
+        """
+        self.cursor.execute("SELECT COUNT(*) FROM fingerprints")
+        total = self.cursor.fetchone()[0]
         
-        print(f"✅ Added {len(fingerprints)} fingerprints for media ID {media_id}")
+        # The hash index returns rows already sorted by hash
+        self.cursor.execute("""
+            SELECT hash, time_offset, media_id
+            FROM fingerprints
+            ORDER BY hash
+        """)
+        rows = np.fromiter(self.cursor, count=total, dtype=[
+            ('hash', np.int64), ('time_offset', np.int32), ('media_id', np.int32)
+        ])
+        
+        token = uuid.uuid4().hex
+        self.columnar.write(rows['hash'], rows['time_offset'], rows['media_id'], token)
+        
+        self.cursor.execute("""
+            INSERT OR REPLACE INTO columnar_snapshot (id, token)
+            VALUES (1, ?)
+        """, (token,))
+        self._commit_unless_batched()
+        
+        self._refresh_columnar()
+    
+    def _refresh_columnar(self):
+        """
+        Load the columnar snapshot if it changed and still matches the table.
+        
+        Returns:
+            True if search can use the columnar snapshot
+        """
+        self.cursor.execute("SELECT token FROM columnar_snapshot")
+        row = self.cursor.fetchone()
+        token = row[0] if row else None
+        
+        if token != self.columnar_token:
+            self.columnar_token = token if self.columnar.load(token) else None
+        
+        return self.columnar_token is not None
+    
+    def has_columnar_snapshot(self):
+        """
+        Check whether search is served from a current columnar snapshot.
+        
+        Returns:
+            True if the columnar snapshot matches the fingerprints table
+        """
+        return self._refresh_columnar()
+    
+    def score_matches(self, query_hashes, query_offsets, bucket=10):
+        """
+        Score media by time offset alignment entirely inside SQLite.
+        
+        The join, delta bucketing and histogram all run in SQL; only one
+        row per matching media comes back to Python.
+        
+        Args:
+            query_hashes: Integer hashes from the clip
+            query_offsets: Time offset of each clip hash
+            bucket: Width of a time delta bucket in frames
+            
+        Returns:
+            List of dicts with media_id, score, time_offset and total_deltas,
+            one per media in no particular order
+        """
+        # Repeated hashes keep every offset, each pairing with the database rows
+        self.cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS score_query (
+                hash INTEGER NOT NULL,
+                t INTEGER NOT NULL
+            )
+        """)
+        self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS temp.idx_score_query_hash ON score_query(hash)
+        """)
+        
+        try:
+            self.cursor.executemany("""
+                INSERT INTO score_query (hash, t) VALUES (?, ?)
+            """, zip(np.asarray(query_hashes).tolist(), np.asarray(query_offsets).tolist()))
+            
+            # Buckets round delta to the nearest multiple of the bucket width,
+            # halves up: floor((delta + half) / width) * width, written with a
+            # non-negative remainder because SQLite's % truncates toward zero;
+            # ties between buckets go to the earliest one
+            self.cursor.execute("""
+                WITH shifted AS (
+                    SELECT fp.media_id, fp.time_offset - q.t + :half AS x
+                    FROM fingerprints fp
+                    JOIN score_query q ON fp.hash = q.hash
+                ), histogram AS (
+                    SELECT media_id,
+                           x - ((x % :width) + :width) % :width AS bucket,
+                           COUNT(*) AS score
+                    FROM shifted
+                    GROUP BY media_id, bucket
+                ), ranked AS (
+                    SELECT media_id, bucket, score,
+                           SUM(score) OVER (PARTITION BY media_id) AS total_deltas,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY media_id ORDER BY score DESC, bucket
+                           ) AS rank
+                    FROM histogram
+                )
+                SELECT media_id, score, bucket, total_deltas
+                FROM ranked
+                WHERE rank = 1
+            """, {'width': bucket, 'half': bucket // 2})
+            rows = self.cursor.fetchall()
+        finally:
+            # Empty the temp table and end the implicit transaction so this
+            # connection doesn't pin an old snapshot of the database
+            self.cursor.execute("DELETE FROM score_query")
+            self._commit_unless_batched()
+        
+        return [{
+            'media_id': row[0],
+            'score': row[1],
+            'time_offset': row[2],
+            'total_deltas': row[3]
+        } for row in rows]
     
     def search_fingerprints(self, query_hashes):
         """
         Search for matching fingerprints.
         
+        Uses the columnar snapshot when it is current, SQLite otherwise.
+        Either way the rows come back sorted by hash.
+        
         Args:
-            query_hashes: List of hash strings to search for
+            query_hashes: Integer hashes to search for
             
         Returns:
-            matches: List of (media_id, hash, time_offset) tuples
+            media_ids: int64 array of media IDs of the matching rows
+            hashes: int64 array of matching hashes
+            time_offsets: int64 array of time offsets
         """
-        placeholders = ','.join('?' * len(query_hashes))
+        if self._refresh_columnar():
+            return self.columnar.search(query_hashes)
         
-        self.cursor.execute(f"""
-            SELECT media_id, hash, time_offset
-            FROM fingerprints
-            WHERE hash IN ({placeholders})
-        """, query_hashes)
+        # Join against a temp table rather than binding one parameter per
+        # hash, which would overrun SQLite's variable limit on long clips
+        self.cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS search_query (
+                hash INTEGER PRIMARY KEY
+            )
+        """)
+        try:
+            self.cursor.executemany("""
+                INSERT OR IGNORE INTO search_query (hash) VALUES (?)
+            """, ((int(h),) for h in query_hashes))
+            
+            self.cursor.execute("""
+                SELECT fp.media_id, fp.hash, fp.time_offset
+                FROM search_query q
+                JOIN fingerprints fp ON fp.hash = q.hash
+                ORDER BY q.hash
+            """)
+            rows = np.array(self.cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+        finally:
+            # Empty the temp table and end the implicit transaction
+            self.cursor.execute("DELETE FROM search_query")
+            self._commit_unless_batched()
         
-        return self.cursor.fetchall()
+        return rows[:, 0], rows[:, 1], rows[:, 2]
     
     def get_media_info(self, media_id):
         """
         Get information about a media item.
         
+        Results are cached until media rows are next written.
+        
+        Args:
+            media_id: ID of the media item
+            
+        Returns:
+            Dictionary with media information
+        """
+        info = self._media_info_cache(media_id)
+        
+        # Hand out a copy so callers can't modify the cached entry
+        return dict(info) if info is not None else None
+    
+    def _fetch_media_info(self, media_id):
+        """
+        Read a media item from the database.
+        
         Args:
             media_id: ID of the media item
             
@@ -184,7 +509,8 @@ class FingerprintDatabase:
             List of media dictionaries
         """
         self.cursor.execute("""
-            SELECT id, title, type, season, episode, file_path, fingerprint_count
+            SELECT id, title, type, season, episode, file_path, fingerprint_count,
+                   source_key
             FROM media
             ORDER BY type, title
         """)
@@ -198,11 +524,30 @@ class FingerprintDatabase:
                 'season': row[3],
                 'episode': row[4],
                 'file_path': row[5],
-                'fingerprint_count': row[6]
+                'fingerprint_count': row[6],
+                'source_key': row[7]
             })
         
         return media_list
     
+    def change_marker(self):
+        """
+        Cheap marker that changes whenever fingerprints are written.
+        
+        Covers commits from other connections (PRAGMA data_version) as well
+        as rows added through this one.
+        
+        Returns:
+            Tuple that compares equal only while the data is unchanged
+        """
+        self.cursor.execute("PRAGMA data_version")
+        data_version = self.cursor.fetchone()[0]
+        
+        self.cursor.execute("SELECT MAX(rowid) FROM fingerprints")
+        last_row = self.cursor.fetchone()[0]
+        
+        return data_version, last_row
+    
     def get_statistics(self):
         """
         Get database statistics.
@@ -237,6 +582,7 @@ class FingerprintDatabase:
         """
         Close database connection.
         """
+        self._media_info_cache.cache_clear()
         self.conn.close()
 
 if __name__ == "__main__":
@@ -252,9 +598,9 @@ if __name__ == "__main__":
     
     # Test adding fingerprints
     test_fingerprints = [
-        ("abc123", 100),
-        ("def456", 200),
-        ("ghi789", 300)
+        (0x1234, 100),
+        (0x5678, 200),
+        (0x9abc, 300)
     ]
     db.add_fingerprints(media_id, test_fingerprints)
     
@@ -1,8 +1,67 @@
 import librosa
+import logging
 import numpy as np
-import hashlib
-from scipy.ndimage import maximum_filter
-from scipy.ndimage import generate_binary_structure, iterate_structure
+import shutil
+import soundfile as sf
+import tempfile
+from math import gcd
+from numba import njit, prange
+from scipy.ndimage import maximum_filter1d
+from scipy.signal import resample_poly
+
+log = logging.getLogger(__name__)
+
+@njit(cache=True, parallel=True)
+def _gen_hashes(peak_f, peak_t, fan_value, time_window, freq_bits, delta_bits):
+    """
+    Pair time-sorted peaks and pack each pair into an integer hash.
+    
+    Anchor peaks are processed in parallel; each writes its own fixed-size
+    slot of the output, and unused slots are compacted away at the end.
+    
+    Args:
+        peak_f: Frequency index of each peak, sorted by time
+        peak_t: Time index of each peak, ascending
+        fan_value: Each peak is paired with the next fan_value - 1 peaks
+        time_window: Maximum time difference for peak pairs
+        freq_bits: Bits used for each frequency in the packed hash
+        delta_bits: Bits used for the time delta in the packed hash
+        
+    Returns:
+        hashes: int64 array of packed hashes
+        offsets: int64 array of anchor times
+    """
+    n = len(peak_f)
+    fan = max(fan_value - 1, 0)
+    freq_mask = (1 << freq_bits) - 1
+    delta_mask = (1 << delta_bits) - 1
+    
+    # Packed hashes are never negative, so -1 marks an empty slot
+    hashes = np.full(n * fan, -1, dtype=np.int64)
+    offsets = np.empty_like(hashes)
+    
+    for i in prange(n):
+        freq1 = np.int64(peak_f[i])
+        time1 = np.int64(peak_t[i])
+        
+        for k in range(fan):
+            j = i + 1 + k
+            if j >= n:
+                break
+            
+            time_delta = np.int64(peak_t[j]) - time1
+            if time_delta > time_window:
+                break
+            
+            freq2 = np.int64(peak_f[j])
+            slot = i * fan + k
+            hashes[slot] = ((freq1 & freq_mask) << (freq_bits + delta_bits)
+                            | (freq2 & freq_mask) << delta_bits
+                            | (time_delta & delta_mask))
+            offsets[slot] = time1
+    
+    keep = hashes >= 0
+    return hashes[keep], offsets[keep]
 
 class AudioFingerprinter:
     """
@@ -30,21 +89,82 @@ class AudioFingerprinter:
         self.fan_value = 5  # Number of peaks to pair with each peak
         self.time_window = 200  # Maximum time difference for peak pairs
         
+        # Hash packing layout: freq1 | freq2 | time_delta
+        # n_fft // 2 + 1 = 1025 frequency bins need 11 bits each
+        self.freq_bits = 11
+        self.delta_bits = 10
+        
     def load_audio(self, file_path):
         """
         Load and preprocess audio file.
         
         Args:
-            file_path: Path to audio file
+            file_path: Path to audio file, or a binary file-like object
+            
+        Returns:
+            y: Audio time series
+            sr: Sample rate
+        """
+        log.info("Loading: %s", file_path)
+        try:
+            return self._load_with_soundfile(file_path)
+        except RuntimeError:
+            # libsndfile can't decode this format; let librosa try its other backends
+            if hasattr(file_path, 'seek'):
+                file_path.seek(0)
+        
+        try:
+            y, sr = librosa.load(file_path, sr=self.sample_rate, mono=True, dtype=np.float32)
+        except Exception:
+            if not hasattr(file_path, 'read'):
+                raise
+            # Formats libsndfile can't read (e.g. M4A) need a real file for audioread
+            y, sr = self._load_via_temp_file(file_path)
+        return y, sr
+    
+    def _load_with_soundfile(self, file_path):
+        """
+        Decode audio with libsndfile and resample with a polyphase filter.
+        
+        Much faster than librosa.load for the MP3/WAV files used here.
+        
+        Args:
+            file_path: Path to audio file, or a binary file-like object
             
         Returns:
             y: Audio time series
             sr: Sample rate
         """
-        print(f"Loading: {file_path}")
-        y, sr = librosa.load(file_path, sr=self.sample_rate, mono=True)
+        y, sr = sf.read(file_path, dtype='float32', always_2d=False)
+        
+        # Downmix to mono
+        if y.ndim > 1:
+            y = y.mean(axis=1, dtype=np.float32)
+        
+        if sr != self.sample_rate:
+            factor = gcd(self.sample_rate, sr)
+            y = resample_poly(y, self.sample_rate // factor, sr // factor).astype(np.float32)
+            sr = self.sample_rate
+        
         return y, sr
     
+    def _load_via_temp_file(self, audio_file):
+        """
+        Load a file-like object by spilling it to a temporary file.
+        
+        Args:
+            audio_file: Binary file-like object
+            
+        Returns:
+            y: Audio time series
+            sr: Sample rate
+        """
+        audio_file.seek(0)
+        with tempfile.NamedTemporaryFile() as tmp:
+            shutil.copyfileobj(audio_file, tmp)
+            tmp.flush()
+            return librosa.load(tmp.name, sr=self.sample_rate, mono=True, dtype=np.float32)
+    
     def generate_spectrogram(self, y):
         """
         Generate spectrogram from audio.
@@ -55,11 +175,12 @@ class AudioFingerprinter:
         Returns:
             spectrogram: 2D array of frequency magnitudes over time
         """
-        # Compute Short-Time Fourier Transform
+        # Compute Short-Time Fourier Transform in single precision
         stft = librosa.stft(y, n_fft=self.n_fft, hop_length=self.hop_length)
+        stft = stft.astype(np.complex64, copy=False)
         
-        # Convert to magnitude
-        spectrogram = np.abs(stft)
+        # Convert to magnitude (float32 halves the bytes moved through the peak filter)
+        spectrogram = np.abs(stft, dtype=np.float32)
         
         return spectrogram
     
@@ -71,81 +192,132 @@ class AudioFingerprinter:
             spectrogram: 2D frequency-time array
             
         Returns:
-            peaks: List of (time_idx, freq_idx) tuples
+            peak_f: int32 array of peak frequency indices, sorted by time
+            peak_t: int32 array of peak time indices, ascending
         """
-        # Create a structure for peak detection
-        struct = generate_binary_structure(2, 1)
-        neighborhood = iterate_structure(struct, self.peak_neighborhood_size)
-        
-        # Find local maxima
-        local_max = maximum_filter(spectrogram, footprint=neighborhood) == spectrogram
+        # Square neighborhood with the same area as a diamond of radius
+        # peak_neighborhood_size, so peak density stays roughly the same
+        radius = self.peak_neighborhood_size
+        size = int(np.sqrt(2 * radius * (radius + 1) + 1))
         
-        # Apply amplitude threshold
-        background = (spectrogram == 0)
-        eroded_background = maximum_filter(background, footprint=neighborhood, mode='constant')
+        # Find local maxima with a separable max filter (one O(N) pass per axis)
+        neighborhood_max = maximum_filter1d(spectrogram, size=size, axis=0)
+        neighborhood_max = maximum_filter1d(neighborhood_max, size=size, axis=1)
+        local_max = neighborhood_max == spectrogram
         
-        # Boolean mask of peaks (local maxima above threshold)
-        detected_peaks = local_max != eroded_background
+        # Boolean mask of peaks (local maxima above threshold); this also
+        # drops the flat maxima of silent regions
+        detected_peaks = local_max & (spectrogram > self.min_amplitude)
         
-        # Extract peak coordinates
-        amps = spectrogram[detected_peaks]
-        peaks = np.array(np.where(detected_peaks)).T
+        # Extract peak coordinates as parallel frequency/time arrays
+        peak_f, peak_t = np.nonzero(detected_peaks)
         
-        # Filter by amplitude
-        peaks = peaks[amps > self.min_amplitude]
+        # Sort peaks by time (stable, so same-frame peaks stay in frequency order)
+        order = np.argsort(peak_t, kind='stable')
+        peak_f = peak_f[order].astype(np.int32, copy=False)
+        peak_t = peak_t[order].astype(np.int32, copy=False)
         
-        print(f"Found {len(peaks)} peaks")
+        log.debug("Found %d peaks", len(peak_f))
         
-        return peaks
+        return peak_f, peak_t
     
-    def generate_hashes(self, peaks):
+    def generate_hashes(self, peak_f, peak_t):
         """
         Generate hashes from peak pairs.
         
         Args:
-            peaks: Array of (freq_idx, time_idx) peak coordinates
+            peak_f: Array of peak frequency indices, sorted by time
+            peak_t: Array of peak time indices, ascending
             
         Returns:
-            fingerprints: List of (hash, time_offset) tuples
+            fingerprints: List of (hash, time_offset) tuples, where hash is a
+                packed integer of (freq1, freq2, time_delta)
+        """
+        hashes, offsets = self.generate_hash_arrays(peak_f, peak_t)
+        
+        # Store hash with anchor time
+        return list(zip(hashes.tolist(), offsets.tolist()))
+    
+    def generate_hash_arrays(self, peak_f, peak_t):
+        """
+        Generate hashes from peak pairs as parallel arrays.
+        
+        Args:
+            peak_f: Array of peak frequency indices, sorted by time
+            peak_t: Array of peak time indices, ascending
+            
+        Returns:
+            hashes: int64 array of packed (freq1, freq2, time_delta) hashes
+            offsets: int64 array of anchor times
+        """
+        hashes, offsets = _gen_hashes(
+            peak_f,
+            peak_t,
+            self.fan_value,
+            self.time_window,
+            self.freq_bits,
+            self.delta_bits
+        )
+        
+        log.debug("Generated %d fingerprints", len(hashes))
+        
+        return hashes, offsets
+    
+    def expand_hashes(self, hashes, offsets, tolerance):
         """
-        # Sort peaks by time
-        peaks = peaks[peaks[:, 1].argsort()]
+        Add variants of each hash with its time delta nudged by up to
+        +/- tolerance frames.
         
-        fingerprints = []
+        Peak timing jitters by a frame or so under noise and re-encoding;
+        looking up the neighbouring deltas lets those pairs still match.
         
-        for i in range(len(peaks)):
-            freq1, time1 = peaks[i]
+        Args:
+            hashes: int64 array of hashes
+            offsets: int64 array of time offsets
+            tolerance: Maximum time delta adjustment in frames
             
-            # Look ahead in time for pairing peaks
-            for j in range(i + 1, min(i + self.fan_value, len(peaks))):
-                freq2, time2 = peaks[j]
-                
-                # Check if within time window
-                time_delta = time2 - time1
-                if time_delta > self.time_window:
-                    break
-                
-                # Create hash from frequency pair and time delta
-                hash_string = f"{freq1}|{freq2}|{time_delta}"
-                hash_value = hashlib.sha1(hash_string.encode('utf-8')).hexdigest()
-                
-                # Store hash with anchor time
-                fingerprints.append((hash_value, int(time1)))
-        
-        print(f"Generated {len(fingerprints)} fingerprints")
-        
-        return fingerprints
+        Returns:
+            hashes: int64 array of hashes including variants
+            offsets: int64 array of time offsets of each variant
+        """
+        if tolerance <= 0 or len(hashes) == 0:
+            return hashes, offsets
+        
+        # The time delta lives in the low bits of the packed hash
+        deltas = hashes & ((1 << self.delta_bits) - 1)
+        nudged = deltas[:, None] + np.arange(-tolerance, tolerance + 1)[None, :]
+        valid = (nudged >= 0) & (nudged <= self.time_window)
+        
+        variants = (hashes - deltas)[:, None] + nudged
+        variant_offsets = np.broadcast_to(offsets[:, None], valid.shape)
+        
+        return variants[valid], variant_offsets[valid]
     
     def fingerprint_file(self, file_path):
         """
         Generate fingerprints for an entire audio file.
         
         Args:
-            file_path: Path to audio file
+            file_path: Path to audio file, or a binary file-like object
             
         Returns:
             fingerprints: List of (hash, time_offset) tuples
         """
+        hashes, offsets = self.fingerprint_arrays(file_path)
+        
+        return list(zip(hashes.tolist(), offsets.tolist()))
+    
+    def fingerprint_arrays(self, file_path):
+        """
+        Generate fingerprints for an entire audio file as parallel arrays.
+        
+        Args:
+            file_path: Path to audio file, or a binary file-like object
+            
+        Returns:
+            hashes: int64 array of hashes
+            offsets: int64 array of time offsets
+        """
         # Load audio
         y, sr = self.load_audio(file_path)
         
@@ -153,14 +325,14 @@ class AudioFingerprinter:
         spectrogram = self.generate_spectrogram(y)
         
         # Find peaks
-        peaks = self.find_peaks(spectrogram)
+        peak_f, peak_t = self.find_peaks(spectrogram)
         
         # Generate hashes
-        fingerprints = self.generate_hashes(peaks)
-        
-        return fingerprints
+        return self.generate_hash_arrays(peak_f, peak_t)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+    
     # Test on one file
     fingerprinter = AudioFingerprinter()
     fingerprints = fingerprinter.fingerprint_file("data/movies/the_dictator.mp3")
@@ -169,4 +341,4 @@ if __name__ == "__main__":
     print(f"Sample fingerprints:")
     for i in range(min(5, len(fingerprints))):
         hash_val, time_offset = fingerprints[i]
-        print(f"  Hash: {hash_val[:16]}... | Time: {time_offset}")
\ No newline at end of file
+        print(f"  Hash: {hash_val:#010x} | Time: {time_offset}")
\ No newline at end of file
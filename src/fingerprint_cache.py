@@ -0,0 +1,104 @@
+import hashlib
+import os
+import numpy as np
+from pathlib import Path
+
+def source_key(file_path, fingerprinter):
+    """
+    Compute a key identifying a file's contents and fingerprint settings.
+    
+    Args:
+        file_path: Path to audio file
+        fingerprinter: AudioFingerprinter that would process the file
+        
+    Returns:
+        Hex digest that changes when the file or settings change
+    """
+    stat = os.stat(file_path)
+    
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{stat.st_size}|{stat.st_mtime_ns}|".encode('utf-8'))
+    
+    # Parameters that change the fingerprints produced
+    params = (fingerprinter.sample_rate, fingerprinter.n_fft, fingerprinter.hop_length,
+              fingerprinter.min_amplitude, fingerprinter.peak_neighborhood_size,
+              fingerprinter.fan_value, fingerprinter.time_window,
+              fingerprinter.freq_bits, fingerprinter.delta_bits)
+    key.update(repr(params).encode('utf-8'))
+    
+    with open(file_path, 'rb') as f:
+        key.update(f.read(1024 * 1024))
+    
+    return key.hexdigest()
+
+class FingerprintCache:
+    """
+    Content-addressed on-disk cache of per-file fingerprints.
+    
+    Lets incremental database rebuilds skip media that hasn't changed.
+    Entries are keyed by file size, modification time, a BLAKE2b of the
+    first megabyte and the fingerprinter's parameters. Clear the cache
+    directory after changing the fingerprinting code itself.
+    """
+    
+    def __init__(self, cache_dir="database/fp_cache"):
+        """
+        Initialize the cache.
+        
+        Args:
+            cache_dir: Directory holding cached .npz files
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    def _key(self, file_path, fingerprinter):
+        """
+        Compute the cache key for a file.
+        
+        Args:
+            file_path: Path to audio file
+            fingerprinter: AudioFingerprinter that would process the file
+            
+        Returns:
+            Hex digest identifying the file contents and settings
+        """
+        return source_key(file_path, fingerprinter)
+    
+    def get(self, file_path, fingerprinter):
+        """
+        Look up cached fingerprints for a file.
+        
+        Args:
+            file_path: Path to audio file
+            fingerprinter: AudioFingerprinter that would process the file
+            
+        Returns:
+            (hashes, offsets) int64 arrays, or None on a miss
+        """
+        entry = self.cache_dir / f"{self._key(file_path, fingerprinter)}.npz"
+        if not entry.exists():
+            return None
+        
+        with np.load(entry) as data:
+            return data['hashes'], data['offsets']
+    
+    def put(self, file_path, fingerprinter, hashes, offsets):
+        """
+        Store fingerprints for a file.
+        
+        Args:
+            file_path: Path to audio file
+            fingerprinter: AudioFingerprinter that produced the fingerprints
+            hashes: int64 array of hashes
+            offsets: int64 array of time offsets
+        """
+        entry = self.cache_dir / f"{self._key(file_path, fingerprinter)}.npz"
+        
+        hashes = np.asarray(hashes, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = entry.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, hashes=hashes, offsets=offsets)
+        os.replace(tmp_path, entry)
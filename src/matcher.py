@@ -1,72 +1,387 @@
-from collections import defaultdict
+import hashlib
+import logging
+import numpy as np
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from numba import njit, prange
 from fingerprint import AudioFingerprinter
 from database import FingerprintDatabase
 
+log = logging.getLogger(__name__)
+
+# Width in frames of the time delta buckets matches are grouped into
+BUCKET = 10
+
+# Number of match results remembered across all matchers
+RESULT_CACHE_SIZE = 128
+
+# Recent match results, least recent first. Shared so pooled matchers
+# (e.g. one per web request) all benefit from each other's work
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+# Numba's fallback workqueue threading layer aborts the process when two
+# threads enter parallel code at once (e.g. overlapping web requests)
+_SCORER_LOCK = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _make_scorer(bucket):
+    """
+    Build the scoring kernel with the bucket width baked in.
+    
+    The width is a compile-time constant inside the kernel, so LLVM can
+    turn the division into a multiply-and-shift. Each width is compiled
+    (and cached on disk) once.
+    
+    Args:
+        bucket: Width of a time delta bucket in frames
+        
+    Returns:
+        Compiled _score_nb(query_hashes, query_offsets, db_media, db_hashes,
+        db_offsets, min_support) function
+    """
+    @njit(cache=True, parallel=True)
+    def _score_nb(query_hashes, query_offsets, db_media, db_hashes, db_offsets, min_support=0):
+        """
+        Histogram time deltas per media and pick each media's best bucket.
+        
+        Media are independent once their deltas are grouped, so each one's
+        histogram and argmax run in parallel. A media's best score can't
+        exceed its number of aligned pairs, so media with fewer than
+        min_support pairs are dropped before grouping.
+        
+        Args:
+            query_hashes: int64 array of clip hashes, sorted ascending
+            query_offsets: int64 array of clip time offsets, in the same order
+            db_media: int64 array of media IDs of the database matches
+            db_hashes: int64 array of hashes of the database matches, sorted ascending
+            db_offsets: int64 array of time offsets of the database matches
+            min_support: Minimum number of aligned pairs for a media to be scored
+            
+        Returns:
+            media: int64 array of scored media IDs
+            scores: int64 array of counts in each media's best bucket
+            deltas: int64 array of each media's best time delta
+            totals: int64 array of aligned pairs per media
+            n_pairs: Number of aligned pairs across all media, scored or not
+        """
+        n_query = len(query_hashes)
+        n_rows = len(db_hashes)
+        
+        # Merge join: both sides are sorted by hash, so one pointer walks the
+        # query while the database rows are scanned in order, recording the
+        # run of clip offsets each row pairs with
+        run_starts = np.empty(n_rows, dtype=np.int64)
+        run_lengths = np.empty(n_rows, dtype=np.int64)
+        start = 0
+        for j in range(n_rows):
+            hash_val = db_hashes[j]
+            while start < n_query and query_hashes[start] < hash_val:
+                start += 1
+            end = start
+            while end < n_query and query_hashes[end] == hash_val:
+                end += 1
+            run_starts[j] = start
+            run_lengths[j] = end - start
+        
+        pair_starts = np.cumsum(run_lengths) - run_lengths
+        n_pairs = run_lengths.sum()
+        
+        # Bucket the delta of every (database row, clip offset) pair
+        pair_media = np.empty(n_pairs, dtype=np.int64)
+        pair_buckets = np.empty(n_pairs, dtype=np.int64)
+        for j in prange(n_rows):
+            for k in range(run_lengths[j]):
+                delta = db_offsets[j] - query_offsets[run_starts[j] + k]
+                
+                # Nearest multiple of the bucket width (halves round up), in
+                # integer arithmetic
+                pair_media[pair_starts[j] + k] = db_media[j]
+                pair_buckets[pair_starts[j] + k] = (delta + bucket // 2) // bucket * bucket
+        
+        # Early reject: one-off collisions from the long tail of media never
+        # reach the sort
+        kept = np.arange(n_pairs)
+        if min_support > 1 and n_pairs > 0:
+            support = np.bincount(pair_media)
+            kept = np.flatnonzero(support[pair_media] >= min_support)
+        
+        # Group pairs by media, buckets ascending within each media, with a
+        # single sort on a packed (media, bucket) key
+        n_grouped = len(kept)
+        grouped_media = pair_media[kept]
+        grouped_buckets = pair_buckets[kept]
+        if n_grouped > 0:
+            bucket_idx = (grouped_buckets - grouped_buckets.min()) // bucket
+            order = np.argsort(grouped_media * (bucket_idx.max() + 1) + bucket_idx)
+            grouped_media = grouped_media[order]
+            grouped_buckets = grouped_buckets[order]
+        
+        # Boundaries of each media's group
+        n_media = 0
+        for i in range(n_grouped):
+            if i == 0 or grouped_media[i] != grouped_media[i - 1]:
+                n_media += 1
+        
+        group_starts = np.empty(n_media + 1, dtype=np.int64)
+        g = 0
+        for i in range(n_grouped):
+            if i == 0 or grouped_media[i] != grouped_media[i - 1]:
+                group_starts[g] = i
+                g += 1
+        group_starts[n_media] = n_grouped
+        
+        media = np.empty(n_media, dtype=np.int64)
+        scores = np.empty(n_media, dtype=np.int64)
+        deltas = np.empty(n_media, dtype=np.int64)
+        totals = np.empty(n_media, dtype=np.int64)
+        
+        # Most common time delta per media; buckets are ascending, so a strict
+        # comparison sends ties to the earliest bucket
+        for m in prange(n_media):
+            lo = group_starts[m]
+            hi = group_starts[m + 1]
+            
+            best_count = 0
+            best_bucket = grouped_buckets[lo]
+            run = 0
+            for i in range(lo, hi):
+                if i > lo and grouped_buckets[i] != grouped_buckets[i - 1]:
+                    run = 0
+                run += 1
+                if run > best_count:
+                    best_count = run
+                    best_bucket = grouped_buckets[i]
+            
+            media[m] = grouped_media[lo]
+            scores[m] = best_count
+            deltas[m] = best_bucket
+            totals[m] = hi - lo
+        
+        return media, scores, deltas, totals, n_pairs
+    
+    return _score_nb
+
 class AudioMatcher:
     """
     Match unknown audio clips against the fingerprint database.
     """
     
-    def __init__(self, db_path="database/fingerprints.db"):
+    def __init__(self, db_path="database/fingerprints.db", check_same_thread=True,
+                 delta_tolerance=0):
         """
         Initialize the matcher.
         
         Args:
             db_path: Path to fingerprint database
+            check_same_thread: Restrict the database connection to the creating thread
+            delta_tolerance: Also look up hashes whose peak-pair time delta is
+                within this many frames of the clip's (0 for exact matching)
         """
         self.fingerprinter = AudioFingerprinter()
-        self.db = FingerprintDatabase(db_path)
+        self.db = FingerprintDatabase(db_path, check_same_thread=check_same_thread)
+        self.delta_tolerance = delta_tolerance
+        
+        # Scoring kernel specialized for the bucket width
+        self._scorer = _make_scorer(BUCKET)
     
-    def match_clip(self, audio_path, min_confidence=5):
+    def match_clip(self, audio_path, min_confidence=5, verbose=False, no_cache=False):
         """
         Match an audio clip against the database.
         
+        Results are remembered by the clip's content, so identifying the
+        same audio again skips fingerprinting and search until the
+        database changes.
+        
         Args:
             audio_path: Path to audio clip to identify
             min_confidence: Minimum number of matching fingerprints
+            verbose: Print a banner and the formatted result
+            no_cache: Always recompute (e.g. for timing runs)
             
         Returns:
             Dictionary with match results or None
         """
-        print(f"\n{'='*70}")
-        print(f"🔍 ANALYZING AUDIO CLIP")
-        print(f"{'='*70}")
-        print(f"File: {audio_path}")
+        if verbose:
+            print(f"\n{'='*70}")
+            print(f"🔍 ANALYZING AUDIO CLIP")
+            print(f"{'='*70}")
+            print(f"File: {audio_path}")
+        
+        if not no_cache:
+            key = self._cache_key('clip', self._content_key(audio_path), min_confidence)
+            hit, result = self._cached_result(key)
+            if hit:
+                log.debug("Using cached result for %s", audio_path)
+                if verbose and result:
+                    self._display_results(result)
+                return result
         
         # Generate fingerprints from the query clip
-        print("\nGenerating fingerprints from clip...")
-        query_fingerprints = self.fingerprinter.fingerprint_file(audio_path)
+        log.debug("Generating fingerprints from %s", audio_path)
+        query_hashes, query_offsets = self.fingerprinter.fingerprint_arrays(audio_path)
         
-        if not query_fingerprints:
-            print("❌ No fingerprints generated from clip")
-            return None
+        result = self.match_fingerprints(query_hashes, query_offsets, min_confidence, verbose,
+                                         no_cache=True)
+        
+        if not no_cache:
+            self._remember_result(key, result)
+        
+        return result
+    
+    def _cache_key(self, kind, digest, min_confidence):
+        """
+        Build a result cache key.
+        
+        Besides the query itself, the key covers everything else the result
+        depends on, so a change to the database or matcher settings misses.
+        
+        Args:
+            kind: 'clip' for clip contents, 'fingerprints' for fingerprint arrays
+            digest: Hex digest of the query
+            min_confidence: Minimum number of matching fingerprints
+            
+        Returns:
+            Hashable cache key
+        """
+        return (kind, digest, min_confidence, self.delta_tolerance,
+                self.db.db_path, self.db.change_marker())
+    
+    def _cached_result(self, key):
+        """
+        Look up a remembered match result.
+        
+        Args:
+            key: Key from _cache_key()
+            
+        Returns:
+            (hit, result) tuple; result is a copy the caller may modify
+        """
+        with _result_cache_lock:
+            if key not in _result_cache:
+                return False, None
+            _result_cache.move_to_end(key)
+            result = _result_cache[key]
+        
+        return True, dict(result) if result else None
+    
+    def _remember_result(self, key, result):
+        """
+        Remember a match result, evicting the least recently used one.
+        
+        Args:
+            key: Key from _cache_key()
+            result: Match result dictionary or None
+        """
+        with _result_cache_lock:
+            _result_cache[key] = dict(result) if result else None
+            if len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+    
+    def _content_key(self, audio_path):
+        """
+        Hash the bytes of an audio clip.
         
-        # Extract just the hashes for searching
-        query_hashes = [fp[0] for fp in query_fingerprints]
+        Args:
+            audio_path: Path to audio clip, or a binary file-like object
+            
+        Returns:
+            Hex digest of the clip's contents
+        """
+        key = hashlib.blake2b(digest_size=16)
         
-        print(f"Searching database for {len(query_hashes)} fingerprints...")
+        if hasattr(audio_path, 'read'):
+            key.update(audio_path.read())
+            audio_path.seek(0)
+        else:
+            with open(audio_path, 'rb') as f:
+                key.update(f.read())
+        
+        return key.hexdigest()
+    
+    def match_fingerprints(self, query_hashes, query_offsets, min_confidence=5, verbose=False,
+                           no_cache=False):
+        """
+        Match precomputed clip fingerprints against the database.
         
-        # Search database
-        matches = self.db.search_fingerprints(query_hashes)
+        Lets callers fingerprint clips elsewhere (e.g. in a worker process)
+        and only do the database lookup and scoring here. Results are
+        remembered by the fingerprints, so the same clip uploaded again
+        skips search and scoring until the database changes.
         
-        if not matches:
-            print("❌ No matches found in database")
+        Args:
+            query_hashes: int64 array of hashes from the clip
+            query_offsets: int64 array of the clip's time offsets
+            min_confidence: Minimum number of matching fingerprints
+            verbose: Print the formatted result
+            no_cache: Always recompute (e.g. for timing runs)
+            
+        Returns:
+            Dictionary with match results or None
+        """
+        if len(query_hashes) == 0:
+            log.info("❌ No fingerprints generated from clip")
             return None
         
-        print(f"Found {len(matches)} matching fingerprints")
+        if not no_cache:
+            key = self._cache_key('fingerprints',
+                                  self._fingerprint_key(query_hashes, query_offsets),
+                                  min_confidence)
+            hit, result = self._cached_result(key)
+            if hit:
+                log.debug("Using cached result for %d fingerprints", len(query_hashes))
+                if verbose and result:
+                    self._display_results(result)
+                return result
+        
+        result = self._match_fingerprints(query_hashes, query_offsets, min_confidence, verbose)
+        
+        if not no_cache:
+            self._remember_result(key, result)
+        
+        return result
+    
+    def _match_fingerprints(self, query_hashes, query_offsets, min_confidence, verbose):
+        """
+        Search and score clip fingerprints, bypassing the result cache.
+        
+        Args:
+            query_hashes: int64 array of hashes from the clip (not empty)
+            query_offsets: int64 array of the clip's time offsets
+            min_confidence: Minimum number of matching fingerprints
+            verbose: Print the formatted result
+            
+        Returns:
+            Dictionary with match results or None
+        """
+        # Tolerate small timing jitter in noisy clips
+        query_hashes, query_offsets = self.fingerprinter.expand_hashes(
+            query_hashes, query_offsets, self.delta_tolerance
+        )
+        
+        log.debug("Searching database for %d fingerprints...", len(query_hashes))
+        
+        # Search database and score matches by media_id and time offset alignment
+        scores, total_matches = self._search_and_score(query_hashes, query_offsets,
+                                                       min_confidence)
+        
+        if not total_matches:
+            log.info("❌ No matches found in database")
+            return None
         
-        # Score matches by media_id and time offset alignment
-        scores = self._score_matches(query_fingerprints, matches)
+        log.debug("Found %d matching fingerprints", total_matches)
         
         if not scores:
-            print("❌ No confident matches after scoring")
+            log.info("❌ No confident matches after scoring")
             return None
         
-        # Get best match
+        # Get best match (scores are unordered; one pass beats sorting them)
         best_match = max(scores, key=lambda x: x['score'])
         
         if best_match['score'] < min_confidence:
-            print(f"❌ Best match score ({best_match['score']}) below confidence threshold ({min_confidence})")
+            log.info("❌ Best match score (%d) below confidence threshold (%d)",
+                     best_match['score'], min_confidence)
             return None
         
         # Get media information
@@ -85,61 +400,117 @@ class AudioMatcher:
             'confidence': best_match['score'],
             'time_offset_seconds': time_offset_seconds,
             'time_offset_formatted': self._format_time(time_offset_seconds),
-            'total_matches': len(matches)
+            'total_matches': total_matches
         }
         
         # Display results
-        self._display_results(result)
+        if verbose:
+            self._display_results(result)
         
         return result
     
-    def _score_matches(self, query_fingerprints, db_matches):
+    def _fingerprint_key(self, query_hashes, query_offsets):
         """
-        Score matches using time offset alignment.
+        Hash a clip's fingerprints independent of their order.
         
         Args:
-            query_fingerprints: List of (hash, time_offset) from query
-            db_matches: List of (media_id, hash, time_offset) from database
+            query_hashes: int64 array of hashes from the clip
+            query_offsets: int64 array of the clip's time offsets
             
         Returns:
-            List of scored matches
-        """
-        # Create lookup for query fingerprints
-        query_dict = {hash_val: time_offset for hash_val, time_offset in query_fingerprints}
-        
-        # Group matches by media_id and calculate time deltas
-        media_matches = defaultdict(list)
-        
-        for media_id, hash_val, db_time_offset in db_matches:
-            if hash_val in query_dict:
-                query_time_offset = query_dict[hash_val]
-                time_delta = db_time_offset - query_time_offset
-                media_matches[media_id].append(time_delta)
-        
-        # Score each media by finding the most common time delta
-        # (indicates alignment between query and database)
-        scores = []
-        
-        for media_id, time_deltas in media_matches.items():
-            # Count occurrences of each time delta
-            delta_counts = defaultdict(int)
-            for delta in time_deltas:
-                # Group deltas within a small window (tolerance for timing variations)
-                delta_bucket = round(delta / 10) * 10
-                delta_counts[delta_bucket] += 1
+            Hex digest of the (hash, offset) pairs
+        """
+        query_hashes = np.asarray(query_hashes, dtype=np.int64)
+        query_offsets = np.asarray(query_offsets, dtype=np.int64)
+        order = np.lexsort((query_offsets, query_hashes))
+        
+        key = hashlib.blake2b(digest_size=16)
+        key.update(np.ascontiguousarray(query_hashes[order]).tobytes())
+        key.update(np.ascontiguousarray(query_offsets[order]).tobytes())
+        
+        return key.hexdigest()
+    
+    def _search_and_score(self, query_hashes, query_offsets, min_confidence=0):
+        """
+        Find and score database matches for the clip's fingerprints.
+        
+        A current columnar snapshot is searched in memory and scored by the
+        Numba kernel; otherwise scoring is pushed down into SQLite.
+        
+        Args:
+            query_hashes: int64 array of hashes from query
+            query_offsets: int64 array of time offsets from query
+            min_confidence: Media with fewer aligned pairs may be left unscored
             
-            # Best score is the most common time delta
-            best_delta = max(delta_counts, key=delta_counts.get)
-            score = delta_counts[best_delta]
+        Returns:
+            scores: List of scored matches, in no particular order
+            total_matches: Number of aligned (clip, database) fingerprint pairs
+        """
+        if not self.db.has_columnar_snapshot():
+            scores = self.db.score_matches(query_hashes, query_offsets, BUCKET)
+            return scores, sum(score['total_deltas'] for score in scores)
+        
+        # Each distinct hash only needs looking up once
+        matches = self.db.search_fingerprints(np.unique(query_hashes))
+        
+        return self._score_matches(query_hashes, query_offsets, matches, min_confidence)
+    
+    def _score_matches(self, query_hashes, query_offsets, db_matches, min_confidence=0):
+        """
+        Score matches using time offset alignment.
+        
+        Args:
+            query_hashes: int64 array of hashes from query
+            query_offsets: int64 array of time offsets from query
+            db_matches: Parallel (media_ids, hashes, time_offsets) arrays from database
+            min_confidence: Skip media with fewer aligned pairs than this,
+                since their score can't reach it
             
-            scores.append({
-                'media_id': media_id,
-                'score': score,
-                'time_offset': best_delta,
-                'total_deltas': len(time_deltas)
-            })
+        Returns:
+            scores: List of scored matches, in no particular order
+            total_matches: Number of aligned (clip, database) fingerprint pairs
+        """
+        # Query lookup as hash-sorted arrays; repeated hashes keep every offset
+        order = np.argsort(query_hashes, kind='stable')
+        query_hashes = np.asarray(query_hashes, dtype=np.int64)[order]
+        query_offsets = np.asarray(query_offsets, dtype=np.int64)[order]
+        
+        media_ids = np.ascontiguousarray(db_matches[0], dtype=np.int64)
+        hashes = np.ascontiguousarray(db_matches[1], dtype=np.int64)
+        db_offsets = np.ascontiguousarray(db_matches[2], dtype=np.int64)
+        
+        # Both search backends return rows grouped by hash in ascending order;
+        # sort defensively so the merge join never misses a pair
+        if np.any(hashes[1:] < hashes[:-1]):
+            order = np.argsort(hashes, kind='stable')
+            media_ids, hashes, db_offsets = media_ids[order], hashes[order], db_offsets[order]
         
-        return sorted(scores, key=lambda x: x['score'], reverse=True)
+        # Group deltas within a small window (tolerance for timing variations);
+        # best score per media is its most common time delta (indicates
+        # alignment between query and database)
+        with _SCORER_LOCK:
+            media, best_counts, best_deltas, total_deltas, total_matches = self._scorer(
+                query_hashes,
+                query_offsets,
+                media_ids,
+                hashes,
+                db_offsets,
+                min_confidence
+            )
+        
+        scores = [{
+            'media_id': media_id,
+            'score': score,
+            'time_offset': best_delta,
+            'total_deltas': total
+        } for media_id, score, best_delta, total in zip(
+            media.tolist(),
+            best_counts.tolist(),
+            best_deltas.tolist(),
+            total_deltas.tolist()
+        )]
+        
+        return scores, total_matches
     
     def _format_time(self, seconds):
         """
@@ -151,8 +522,7 @@ class AudioMatcher:
         Returns:
             Formatted string
         """
-        minutes = int(seconds // 60)
-        secs = int(seconds % 60)
+        minutes, secs = divmod(int(seconds), 60)
         return f"{minutes:02d}:{secs:02d}"
     
     def _display_results(self, result):
@@ -196,8 +566,10 @@ if __name__ == "__main__":
     
     clip_path = sys.argv[1]
     
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     matcher = AudioMatcher()
-    result = matcher.match_clip(clip_path)
+    result = matcher.match_clip(clip_path, verbose=True)
     matcher.close()
     
     if result: